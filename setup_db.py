@@ -1,27 +1,30 @@
 import sqlite3
 import os
+import sys
+from squirrel_db import DB_FILE, SCHEMA_VERSION, migrate
 
 DB_TEMPLATE = "squirrel_db_template.db"
 
 
-if os.path.exists(DB_TEMPLATE):
-    os.remove(DB_TEMPLATE)
-
+# --migrate upgrades the existing databases in place instead of recreating
+# the template from scratch.
+if "--migrate" in sys.argv[1:]:
+    for filename in [DB_TEMPLATE, DB_FILE]:
+        if os.path.exists(filename):
+            connection = sqlite3.connect(filename, isolation_level=None)
+            applied = migrate(connection)
+            connection.close()
+            print(f"{filename}: applied migrations {applied or 'none'}")
+    sys.exit(0)
 
-connection = sqlite3.connect(DB_TEMPLATE)
-cursor = connection.cursor()
 
+if os.path.exists(DB_TEMPLATE):
+    os.remove(DB_TEMPLATE)
 
-cursor.execute("""
-    CREATE TABLE squirrels (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        size TEXT NOT NULL
-    )
-""")
 
-connection.commit()
+connection = sqlite3.connect(DB_TEMPLATE, isolation_level=None)
+migrate(connection)
 connection.close()
 
-print(f"Created!")
-print("Run tests with: pytest --spec")
\ No newline at end of file
+print(f"Created schema version {SCHEMA_VERSION}!")
+print("Run tests with: pytest --spec")
@@ -1,4 +1,82 @@
+import os.path
 import sqlite3
+import threading
+import time
+
+DB_FILE = "squirrel_db.db"
+
+# Each migration is (version, description, statements). The applied version is
+# stored in PRAGMA user_version, so append new migrations; never edit old ones.
+MIGRATIONS = [
+    (1, "create squirrels table", [
+        """
+        CREATE TABLE IF NOT EXISTS squirrels (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            size TEXT NOT NULL
+        )
+        """,
+    ]),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+SQUIRREL_COLUMNS = ["id", "name", "size"]
+WARM_CHUNK_SIZE = 1024 * 1024
+
+class SchemaError(Exception):
+    pass
+
+def getSchemaVersion(connection):
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(connection, migrations=MIGRATIONS):
+    current = getSchemaVersion(connection)
+    latest = migrations[-1][0] if migrations else 0
+    if current > latest:
+        raise SchemaError(f"database schema version {current} is newer than supported version {latest}")
+    applied = []
+    for version, description, statements in migrations:
+        if version <= current:
+            continue
+        # Run each migration in its own transaction together with the
+        # user_version bump, so a failure leaves the previous version intact.
+        connection.execute("BEGIN")
+        try:
+            for statement in statements:
+                connection.execute(statement)
+            connection.execute(f"PRAGMA user_version = {int(version)}")
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+        applied.append(version)
+    return applied
+
+def validateSchema(connection):
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(squirrels)")]
+    if not columns:
+        raise SchemaError("missing table: squirrels")
+    missing = [column for column in SQUIRREL_COLUMNS if column not in columns]
+    if missing:
+        raise SchemaError(f"squirrels table is missing columns: {', '.join(missing)}")
+    return None
+
+def warmPageCache(filename):
+    # Reading the file once pulls it into the OS page cache, which is what the
+    # per-request connections read from.
+    with open(filename, "rb") as f:
+        while f.read(WARM_CHUNK_SIZE):
+            pass
+
+def parseSquirrelId(squirrelId):
+    # Only canonical decimal ids are accepted. SQLite would also match "1.0",
+    # "+1" or "01" against row 1, which would let the write-behind key and the
+    # row being read or written disagree.
+    if isinstance(squirrelId, int) and not isinstance(squirrelId, bool):
+        return squirrelId
+    if isinstance(squirrelId, str) and squirrelId.isascii() and squirrelId.isdigit():
+        if str(int(squirrelId)) == squirrelId:
+            return int(squirrelId)
+    return None
 
 def dict_factory(cursor, row):
     d = {}
@@ -6,19 +84,220 @@ def dict_factory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
+class WriteBehindBuffer:
+
+    # Keeps the latest (name, size) per squirrel id in memory and writes the
+    # merged result to SQLite in one transaction every flushInterval seconds.
+    # maxStaleness is best-effort: if the flusher falls behind, the next
+    # update flushes inline, and a failed flush keeps its rows pending for
+    # the next tick. Every tick that ends with a write older than
+    # maxStaleness still unflushed is counted in stalenessOverruns.
+
+    def __init__(self, filename=DB_FILE, flushInterval=0.05, maxStaleness=0.5, busyTimeout=5.0):
+        self.filename = filename
+        self.flushInterval = flushInterval
+        self.maxStaleness = maxStaleness
+        self.busyTimeout = busyTimeout
+        self.lock = threading.Lock()
+        self.flushLock = threading.Lock()
+        self.pending = {}
+        self.flushing = {}
+        self.oldestPendingAt = None
+        self.stopEvent = threading.Event()
+        self.thread = None
+        self.stats = {
+            "queued": 0,
+            "coalesced": 0,
+            "flushed": 0,
+            "dropped": 0,
+            "flushes": 0,
+            "flushErrors": 0,
+            "forcedFlushes": 0,
+            "stalenessOverruns": 0,
+            "worstStaleness": 0.0,
+            "lastFlushAt": None,
+        }
+
+    def start(self):
+        if self.thread is None:
+            self.stopEvent.clear()
+            self.thread = threading.Thread(target=self.run, name="squirrel-write-behind", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopEvent.set()
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def run(self):
+        while not self.stopEvent.wait(self.flushInterval):
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # Counted in flushErrors; the rows stay pending for the next tick.
+                pass
+            self.checkStaleness()
+
+    def checkStaleness(self):
+        with self.lock:
+            if self.getOldestPendingAge() > self.maxStaleness:
+                self.stats["stalenessOverruns"] += 1
+
+    def getOldestPendingAge(self):
+        if self.oldestPendingAt is None:
+            return 0.0
+        return time.monotonic() - self.oldestPendingAt
+
+    def put(self, squirrelId, name, size):
+        with self.lock:
+            if squirrelId in self.pending:
+                self.stats["coalesced"] += 1
+            elif not self.pending:
+                self.oldestPendingAt = time.monotonic()
+            self.pending[squirrelId] = {"id": squirrelId, "name": name, "size": size}
+            self.stats["queued"] += 1
+            overdue = time.monotonic() - self.oldestPendingAt >= self.maxStaleness
+            if overdue:
+                self.stats["forcedFlushes"] += 1
+        if overdue:
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # Counted in flushErrors; the update stays buffered and is
+                # retried by the flusher, so the caller still succeeds.
+                pass
+
+    def get(self, squirrelId):
+        with self.lock:
+            squirrel = self.pending.get(squirrelId) or self.flushing.get(squirrelId)
+            return dict(squirrel) if squirrel else None
+
+    def discard(self, squirrelId):
+        # Waits for any in-flight flush so a stale UPDATE cannot land after
+        # the caller's DELETE.
+        with self.flushLock:
+            with self.lock:
+                self.pending.pop(squirrelId, None)
+                if not self.pending:
+                    self.oldestPendingAt = None
+
+    def flush(self):
+        with self.flushLock:
+            with self.lock:
+                if not self.pending:
+                    return 0
+                self.flushing = self.pending
+                self.pending = {}
+                startedAt = self.oldestPendingAt
+                self.oldestPendingAt = None
+            rows = [(s["name"], s["size"], s["id"]) for s in self.flushing.values()]
+            try:
+                connection = sqlite3.connect(self.filename, timeout=self.busyTimeout)
+                try:
+                    with connection:
+                        written = connection.executemany("UPDATE squirrels SET name = ?, size = ? WHERE id = ?", rows).rowcount
+                finally:
+                    connection.close()
+            except BaseException:
+                # BaseException so a SystemExit from the SIGTERM handler
+                # cannot lose the rows being flushed.
+                with self.lock:
+                    # Newer values queued during the failed flush win.
+                    for squirrelId, squirrel in self.flushing.items():
+                        self.pending.setdefault(squirrelId, squirrel)
+                    if self.oldestPendingAt is None or startedAt < self.oldestPendingAt:
+                        self.oldestPendingAt = startedAt
+                    self.flushing = {}
+                    self.stats["flushErrors"] += 1
+                raise
+            with self.lock:
+                self.flushing = {}
+                now = time.monotonic()
+                self.stats["flushed"] += written
+                self.stats["dropped"] += len(rows) - written
+                self.stats["flushes"] += 1
+                self.stats["worstStaleness"] = max(self.stats["worstStaleness"], now - startedAt)
+                self.stats["lastFlushAt"] = time.time()
+            return written
+
+    def getStats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["pending"] = len(self.pending) + len(self.flushing)
+            stats["oldestPendingAge"] = self.getOldestPendingAge()
+            return stats
+
 class SquirrelDB:
 
+    writeBehind = None
+
     def __init__(self):
-        self.connection = sqlite3.connect("squirrel_db.db")
+        self.connection = sqlite3.connect(DB_FILE)
         self.connection.row_factory = dict_factory
         self.cursor = self.connection.cursor()
 
+    @classmethod
+    def prepare(cls, warm=False):
+        # sqlite3.connect would silently create an empty database here, so a
+        # server started from the wrong directory would serve no squirrels.
+        # New databases are created by setup_db.py.
+        if not os.path.isfile(DB_FILE):
+            raise SchemaError(f"database file not found: {os.path.abspath(DB_FILE)}")
+        connection = sqlite3.connect(DB_FILE, isolation_level=None)
+        try:
+            applied = migrate(connection)
+            validateSchema(connection)
+        finally:
+            connection.close()
+        if warm:
+            warmPageCache(DB_FILE)
+            # Step each query once without fetching the whole table.
+            db = cls()
+            db.cursor.execute("SELECT * FROM squirrels ORDER BY id")
+            db.cursor.fetchone()
+            db.getSquirrel(0)
+            db.connection.close()
+        return applied
+
+    @classmethod
+    def enableWriteBehind(cls, flushInterval=0.05, maxStaleness=0.5):
+        if cls.writeBehind is None:
+            cls.writeBehind = WriteBehindBuffer(DB_FILE, flushInterval, maxStaleness)
+            cls.writeBehind.start()
+        return cls.writeBehind
+
+    @classmethod
+    def disableWriteBehind(cls):
+        if cls.writeBehind is not None:
+            writeBehind = cls.writeBehind
+            cls.writeBehind = None
+            writeBehind.stop()
+
+    @classmethod
+    def getWriteBehindStats(cls):
+        if cls.writeBehind is None:
+            return None
+        return cls.writeBehind.getStats()
+
     def getSquirrels(self):
         self.cursor.execute("SELECT * FROM squirrels ORDER BY id")
-        return self.cursor.fetchall()
+        squirrels = self.cursor.fetchall()
+        if self.writeBehind is not None:
+            for squirrel in squirrels:
+                squirrel.update(self.writeBehind.get(squirrel["id"]) or {})
+        return squirrels
 
     def getSquirrel(self, squirrelId):
-        data = [squirrelId]
+        key = parseSquirrelId(squirrelId)
+        if key is None:
+            return None
+        if self.writeBehind is not None:
+            squirrel = self.writeBehind.get(key)
+            if squirrel:
+                return squirrel
+        data = [key]
         self.cursor.execute("SELECT * FROM squirrels WHERE id = ?", data)
         return self.cursor.fetchone()
 
@@ -28,14 +307,48 @@ class SquirrelDB:
         self.connection.commit()
         return None
 
-    def updateSquirrel(self, squirrelId, name, size):
-        data = [name, size, squirrelId]
+    def createSquirrels(self, squirrels):
+        # squirrels is any iterable of (name, size) pairs; it is consumed
+        # lazily so bulk request bodies never need to be materialised. Rows
+        # are staged in a TEMP table, which does not lock the main database,
+        # so a slow client never holds the squirrels write lock; the copy
+        # into squirrels is a single short transaction.
+        self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS pending_squirrels (name TEXT NOT NULL, size TEXT NOT NULL)")
+        try:
+            self.cursor.executemany("INSERT INTO pending_squirrels (name, size) VALUES (?, ?)", squirrels)
+            self.cursor.execute("INSERT INTO squirrels (name, size) SELECT name, size FROM pending_squirrels ORDER BY rowid")
+            self.cursor.execute("DELETE FROM pending_squirrels")
+        except BaseException:
+            self.connection.rollback()
+            raise
+        self.connection.commit()
+        return None
+
+    def updateSquirrel(self, squirrelId, name, size, squirrel=None):
+        key = parseSquirrelId(squirrelId)
+        if key is None:
+            return None
+        if self.writeBehind is not None:
+            # Only buffer ids that exist, so reads never see a phantom row.
+            # Callers that already fetched the squirrel pass it in to skip a
+            # second lookup.
+            if squirrel is None:
+                squirrel = self.getSquirrel(key)
+            if squirrel is not None:
+                self.writeBehind.put(squirrel["id"], name, size)
+            return None
+        data = [name, size, key]
         self.cursor.execute("UPDATE squirrels SET name = ?, size = ? WHERE id = ?", data)
         self.connection.commit()
         return None
 
     def deleteSquirrel(self, squirrelId):
-        data = [squirrelId]
+        key = parseSquirrelId(squirrelId)
+        if key is None:
+            return None
+        if self.writeBehind is not None:
+            self.writeBehind.discard(key)
+        data = [key]
         self.cursor.execute("DELETE FROM squirrels WHERE id = ?", data)
         self.connection.commit()
         return None
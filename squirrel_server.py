@@ -1,7 +1,24 @@
+import codecs
 import json
+import signal
+import sys
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from urllib.parse import parse_qs
-from squirrel_db import SquirrelDB
+from squirrel_db import SchemaError, SquirrelDB
+
+FORM_CONTENT_TYPE = "application/x-www-form-urlencoded"
+JSON_CONTENT_TYPE = "application/json"
+MAX_BODY_SIZE = 64 * 1024
+MAX_BULK_BODY_SIZE = 8 * 1024 * 1024
+READ_CHUNK_SIZE = 16 * 1024
+JSON_WHITESPACE = " \t\n\r"
+
+class RequestBodyError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
 
 class SquirrelServerHandler(BaseHTTPRequestHandler):
 
@@ -49,13 +66,153 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
 
     # HELPERS
 
+    def getContentType(self):
+        # Clients that send no Content-Type (e.g. plain `curl -d`) get the
+        # historical form-encoded behaviour.
+        if "Content-Type" not in self.headers:
+            return FORM_CONTENT_TYPE
+        return self.headers.get_content_type()
+
+    def getContentLength(self, limit):
+        header = self.headers.get("Content-Length")
+        if header is None:
+            if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+                raise RequestBodyError(411, "Content-Length required")
+            return 0
+        try:
+            length = int(header)
+        except ValueError:
+            raise RequestBodyError(400, "Invalid Content-Length")
+        if length < 0:
+            raise RequestBodyError(400, "Invalid Content-Length")
+        if length > limit:
+            raise RequestBodyError(413, "Request body too large")
+        return length
+
+    def readBody(self, length):
+        body = self.rfile.read(length) if length else b""
+        if len(body) < length:
+            raise RequestBodyError(400, "Incomplete request body")
+        return body
+
     def getRequestData(self):
-        length = int(self.headers["Content-Length"])
-        body = self.rfile.read(length).decode("utf-8")
-        data = parse_qs(body)
-        for key in data:
-            data[key] = data[key][0]
-        return data
+        contentType = self.getContentType()
+        if contentType == JSON_CONTENT_TYPE:
+            body = self.readBody(self.getContentLength(MAX_BODY_SIZE))
+            if not body:
+                return {}
+            try:
+                # json.loads detects the UTF encoding and decodes the bytes
+                # itself; that is the only decode of the body.
+                data = json.loads(body)
+            except ValueError:
+                raise RequestBodyError(400, "Invalid JSON body")
+            if not isinstance(data, dict):
+                raise RequestBodyError(400, "JSON body must be an object")
+            return data
+        if contentType == FORM_CONTENT_TYPE:
+            body = self.readBody(self.getContentLength(MAX_BODY_SIZE))
+            charset = self.headers.get_content_charset("utf-8")
+            try:
+                data = parse_qs(body.decode(charset))
+            except (LookupError, UnicodeDecodeError):
+                raise RequestBodyError(400, "Invalid form body")
+            for key in data:
+                data[key] = data[key][0]
+            return data
+        raise RequestBodyError(415, "Unsupported Content-Type")
+
+    def iterRequestItems(self):
+        if self.getContentType() == JSON_CONTENT_TYPE:
+            return self.iterJsonObjects(self.getContentLength(MAX_BULK_BODY_SIZE))
+        return iter([self.getRequestData()])
+
+    def iterJsonObjects(self, length):
+        # Yields a single JSON object, or each object of a top-level JSON
+        # array, while reading the body from rfile in fixed-size chunks. Only
+        # the object currently being decoded is buffered, and it is held to
+        # MAX_BODY_SIZE.
+        textDecoder = codecs.getincrementaldecoder("utf-8")()
+        objectDecoder = json.JSONDecoder()
+        remaining = length
+        buffer = ""
+        pos = 0
+        inArray = False
+        state = "start"
+        while True:
+            while pos < len(buffer) and buffer[pos] in JSON_WHITESPACE:
+                pos += 1
+            needMore = pos == len(buffer)
+            if not needMore:
+                char = buffer[pos]
+                if state == "start":
+                    if char == "[":
+                        inArray = True
+                        state = "first"
+                        pos += 1
+                    elif char == "{":
+                        state = "value"
+                    else:
+                        raise RequestBodyError(400, "JSON body must be an object or array of objects")
+                    continue
+                if state == "first" and char == "]":
+                    state = "end"
+                    pos += 1
+                    continue
+                if state == "separator":
+                    if char == ",":
+                        state = "value"
+                    elif char == "]":
+                        state = "end"
+                    else:
+                        raise RequestBodyError(400, "Invalid JSON body")
+                    pos += 1
+                    continue
+                if state == "end" or char != "{":
+                    raise RequestBodyError(400, "Invalid JSON body")
+                try:
+                    value, pos = objectDecoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError as error:
+                    if not self.isTruncatedJson(error):
+                        raise RequestBodyError(400, "Invalid JSON body")
+                    needMore = True
+                else:
+                    state = "separator" if inArray else "end"
+                    yield value
+                    continue
+            if not remaining:
+                if state != "end" or pos != len(buffer):
+                    raise RequestBodyError(400, "Invalid JSON body")
+                return
+            chunk = self.rfile.read(min(READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise RequestBodyError(400, "Incomplete request body")
+            remaining -= len(chunk)
+            try:
+                text = textDecoder.decode(chunk, final=not remaining)
+            except UnicodeDecodeError:
+                raise RequestBodyError(400, "Invalid JSON body")
+            buffer = buffer[pos:] + text
+            pos = 0
+            if len(buffer) > MAX_BODY_SIZE:
+                raise RequestBodyError(413, "Request body too large")
+
+    def isTruncatedJson(self, error):
+        # A value cut off by a chunk boundary fails either on an open string
+        # or on the last token in the buffer, which is never longer than
+        # "-Infinity". Anything earlier is a real syntax error.
+        if error.msg.startswith("Unterminated string"):
+            return True
+        return len(error.doc) - error.pos <= len("-Infinity")
+
+    def getSquirrelFields(self, data):
+        if not isinstance(data, dict):
+            raise RequestBodyError(400, "Squirrel must be an object")
+        name = data.get("name")
+        size = data.get("size")
+        if not isinstance(name, str) or not isinstance(size, str):
+            raise RequestBodyError(400, "Squirrel requires string name and size")
+        return (name, size)
 
     def parsePath(self):
         if self.path.startswith("/"):
@@ -90,8 +247,12 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
 
     def handleSquirrelsCreate(self):
         db = SquirrelDB()
-        body = self.getRequestData()
-        db.createSquirrel(body["name"], body["size"])
+        try:
+            items = self.iterRequestItems()
+            db.createSquirrels(self.getSquirrelFields(item) for item in items)
+        except RequestBodyError as error:
+            self.handleRequestError(error)
+            return
         self.send_response(201)
         self.end_headers()
 
@@ -99,8 +260,12 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
         db = SquirrelDB()
         squirrel = db.getSquirrel(squirrelId)
         if squirrel:
-            body = self.getRequestData()
-            db.updateSquirrel(squirrelId, body["name"], body["size"])
+            try:
+                name, size = self.getSquirrelFields(self.getRequestData())
+            except RequestBodyError as error:
+                self.handleRequestError(error)
+                return
+            db.updateSquirrel(squirrelId, name, size, squirrel)
             self.send_response(204)
             self.end_headers()
         else:
@@ -122,12 +287,34 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(bytes("404 Not Found", "utf-8"))
 
-def run():
+    def handleRequestError(self, error):
+        self.send_response(error.status)
+        self.send_header("Content-Type", "text/plain")
+        self.end_headers()
+        self.wfile.write(bytes(f"{error.status} {error.message}", "utf-8"))
+
+def run(writeBehind=False, warm=False):
+    try:
+        applied = SquirrelDB.prepare(warm=warm)
+    except SchemaError as error:
+        sys.exit(f"squirrel_server: cannot use database: {error}")
+    for version in applied:
+        print(f"applied schema migration {version}")
     print("squirrel_server running at 127.0.0.1:8082")
     listen = ("127.0.0.1", 8082)
     server = HTTPServer(listen, SquirrelServerHandler)
-    server.serve_forever()
+    if writeBehind:
+        SquirrelDB.enableWriteBehind()
+        # Turn SIGTERM into a normal exit so buffered updates get flushed.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        SquirrelDB.disableWriteBehind()
 
 if __name__ == '__main__':
-    run()
+    run(writeBehind="--write-behind" in sys.argv[1:], warm="--warm" in sys.argv[1:])
 
@@ -0,0 +1,280 @@
+import os
+import shutil
+import sqlite3
+import time
+import pytest
+from pytest import fixture
+import squirrel_db
+from squirrel_db import SchemaError, SquirrelDB, SCHEMA_VERSION, getSchemaVersion, migrate, validateSchema
+
+TEMPLATE_DB = "squirrel_db_template.db"
+
+def describe_SquirrelDB():
+
+    @fixture
+    def db_file(tmp_path, monkeypatch):
+        filename = str(tmp_path / "squirrel_db.db")
+        shutil.copy(TEMPLATE_DB, filename)
+        monkeypatch.setattr(squirrel_db, "DB_FILE", filename)
+        yield filename
+        SquirrelDB.disableWriteBehind()
+
+    def _read_disk(filename, squirrelId):
+        connection = sqlite3.connect(filename)
+        row = connection.execute("SELECT name, size FROM squirrels WHERE id = ?", [squirrelId]).fetchone()
+        connection.close()
+        return row
+
+    def describe_createSquirrels():
+        def creates_all_squirrels(db_file):
+            SquirrelDB().createSquirrels((f"Bulk{i}", "small") for i in range(3))
+            assert [s["name"] for s in SquirrelDB().getSquirrels()] == ["Bulk0", "Bulk1", "Bulk2"]
+
+        def creates_nothing_when_input_fails(db_file):
+            def squirrels():
+                yield ("Good", "small")
+                raise ValueError("bad squirrel")
+            with pytest.raises(ValueError):
+                SquirrelDB().createSquirrels(squirrels())
+            assert SquirrelDB().getSquirrels() == []
+
+        def does_not_lock_database_while_reading_input(db_file):
+            def squirrels():
+                yield ("Slow", "small")
+                other = sqlite3.connect(db_file, timeout=0)
+                other.execute("INSERT INTO squirrels (name, size) VALUES ('Other', 'large')")
+                other.commit()
+                other.close()
+                yield ("Client", "small")
+            SquirrelDB().createSquirrels(squirrels())
+            assert [s["name"] for s in SquirrelDB().getSquirrels()] == ["Other", "Slow", "Client"]
+
+    @fixture
+    def empty_connection(tmp_path):
+        connection = sqlite3.connect(str(tmp_path / "empty.db"), isolation_level=None)
+        yield connection
+        connection.close()
+
+    def describe_migrate():
+        def creates_schema_in_empty_database(empty_connection):
+            assert migrate(empty_connection) == list(range(1, SCHEMA_VERSION + 1))
+            assert getSchemaVersion(empty_connection) == SCHEMA_VERSION
+            validateSchema(empty_connection)
+
+        def is_idempotent(empty_connection):
+            migrate(empty_connection)
+            assert migrate(empty_connection) == []
+
+        def applies_only_pending_migrations(empty_connection):
+            migrate(empty_connection)
+            migrations = squirrel_db.MIGRATIONS + [
+                (SCHEMA_VERSION + 1, "index names", ["CREATE INDEX squirrels_name ON squirrels (name)"]),
+            ]
+            assert migrate(empty_connection, migrations) == [SCHEMA_VERSION + 1]
+            assert getSchemaVersion(empty_connection) == SCHEMA_VERSION + 1
+
+        def keeps_version_when_migration_fails(empty_connection):
+            migrate(empty_connection)
+            migrations = squirrel_db.MIGRATIONS + [
+                (SCHEMA_VERSION + 1, "broken", ["CREATE INDEX broken ON squirrels (name)", "NOT SQL"]),
+            ]
+            with pytest.raises(sqlite3.Error):
+                migrate(empty_connection, migrations)
+            assert getSchemaVersion(empty_connection) == SCHEMA_VERSION
+            assert empty_connection.execute("SELECT name FROM sqlite_master WHERE name = 'broken'").fetchone() is None
+
+        def rejects_newer_database(empty_connection):
+            empty_connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION + 1}")
+            with pytest.raises(SchemaError):
+                migrate(empty_connection)
+
+        def upgrades_unversioned_template(db_file):
+            connection = sqlite3.connect(db_file, isolation_level=None)
+            migrate(connection)
+            assert getSchemaVersion(connection) == SCHEMA_VERSION
+            connection.close()
+
+    def describe_validateSchema():
+        def rejects_missing_table(empty_connection):
+            with pytest.raises(SchemaError):
+                validateSchema(empty_connection)
+
+        def rejects_missing_column(empty_connection):
+            empty_connection.execute("CREATE TABLE squirrels (id INTEGER PRIMARY KEY, name TEXT)")
+            with pytest.raises(SchemaError):
+                validateSchema(empty_connection)
+
+    def describe_prepare():
+        def migrates_and_warms_database(db_file):
+            SquirrelDB().createSquirrel("Rocky", "large")
+            assert SquirrelDB.prepare(warm=True) == list(range(1, SCHEMA_VERSION + 1))
+            assert SquirrelDB.prepare(warm=True) == []
+            assert SquirrelDB().getSquirrel(1)["name"] == "Rocky"
+
+        def rejects_missing_database(tmp_path, monkeypatch):
+            filename = str(tmp_path / "missing.db")
+            monkeypatch.setattr(squirrel_db, "DB_FILE", filename)
+            with pytest.raises(SchemaError):
+                SquirrelDB.prepare(warm=True)
+            assert not os.path.exists(filename)
+
+    def describe_write_behind():
+        def update_is_not_buffered_by_default(db_file):
+            db = SquirrelDB()
+            db.createSquirrel("Rocky", "large")
+            db.updateSquirrel(1, "Rocky", "small")
+            assert _read_disk(db_file, 1) == ("Rocky", "small")
+
+        def reads_see_buffered_update(db_file):
+            SquirrelDB().createSquirrel("Rocky", "large")
+            SquirrelDB.enableWriteBehind(flushInterval=60, maxStaleness=60)
+            SquirrelDB().updateSquirrel("1", "Rocky", "small")
+            assert _read_disk(db_file, 1) == ("Rocky", "large")
+            assert SquirrelDB().getSquirrel("1") == {"id": 1, "name": "Rocky", "size": "small"}
+            assert SquirrelDB().getSquirrels()[0]["size"] == "small"
+
+        def coalesces_updates_into_one_write(db_file):
+            SquirrelDB().createSquirrel("Rocky", "large")
+            writeBehind = SquirrelDB.enableWriteBehind(flushInterval=60, maxStaleness=60)
+            for size in ["tiny", "small", "medium"]:
+                SquirrelDB().updateSquirrel(1, "Rocky", size)
+            assert writeBehind.flush() == 1
+            assert _read_disk(db_file, 1) == ("Rocky", "medium")
+            stats = SquirrelDB.getWriteBehindStats()
+            assert stats["queued"] == 3
+            assert stats["coalesced"] == 2
+            assert stats["flushed"] == 1
+            assert stats["pending"] == 0
+
+        def flushes_on_interval(db_file):
+            SquirrelDB().createSquirrel("Rocky", "large")
+            SquirrelDB.enableWriteBehind(flushInterval=0.01, maxStaleness=60)
+            SquirrelDB().updateSquirrel(1, "Rocky", "small")
+            deadline = time.monotonic() + 2
+            while _read_disk(db_file, 1) != ("Rocky", "small") and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert _read_disk(db_file, 1) == ("Rocky", "small")
+
+        def flushes_inline_when_too_stale(db_file):
+            SquirrelDB().createSquirrel("Rocky", "large")
+            SquirrelDB.enableWriteBehind(flushInterval=60, maxStaleness=0)
+            SquirrelDB().updateSquirrel(1, "Rocky", "small")
+            assert _read_disk(db_file, 1) == ("Rocky", "small")
+            assert SquirrelDB.getWriteBehindStats()["forcedFlushes"] == 1
+
+        def flushes_on_disable(db_file):
+            SquirrelDB().createSquirrel("Rocky", "large")
+            SquirrelDB.enableWriteBehind(flushInterval=60, maxStaleness=60)
+            SquirrelDB().updateSquirrel(1, "Rocky", "small")
+            SquirrelDB.disableWriteBehind()
+            assert _read_disk(db_file, 1) == ("Rocky", "small")
+
+        def delete_drops_buffered_update(db_file):
+            SquirrelDB().createSquirrel("Rocky", "large")
+            writeBehind = SquirrelDB.enableWriteBehind(flushInterval=60, maxStaleness=60)
+            SquirrelDB().updateSquirrel(1, "Rocky", "small")
+            SquirrelDB().deleteSquirrel(1)
+            assert SquirrelDB().getSquirrel(1) is None
+            assert writeBehind.flush() == 0
+
+        def does_not_buffer_unknown_squirrel(db_file):
+            SquirrelDB.enableWriteBehind(flushInterval=60, maxStaleness=60)
+            SquirrelDB().updateSquirrel(999, "Ghost", "small")
+            assert SquirrelDB().getSquirrel(999) is None
+            assert SquirrelDB.getWriteBehindStats()["queued"] == 0
+
+        def counts_rows_deleted_before_flush_as_dropped(db_file):
+            SquirrelDB().createSquirrel("Rocky", "large")
+            writeBehind = SquirrelDB.enableWriteBehind(flushInterval=60, maxStaleness=60)
+            SquirrelDB().updateSquirrel(1, "Rocky", "small")
+            connection = sqlite3.connect(db_file)
+            connection.execute("DELETE FROM squirrels WHERE id = 1")
+            connection.commit()
+            connection.close()
+            assert writeBehind.flush() == 0
+            stats = SquirrelDB.getWriteBehindStats()
+            assert stats["flushed"] == 0
+            assert stats["dropped"] == 1
+
+        def keeps_update_when_forced_flush_is_locked_out(db_file):
+            SquirrelDB().createSquirrel("Rocky", "large")
+            writeBehind = SquirrelDB.enableWriteBehind(flushInterval=60, maxStaleness=0)
+            writeBehind.busyTimeout = 0
+            lock = sqlite3.connect(db_file, isolation_level=None)
+            lock.execute("BEGIN IMMEDIATE")
+            try:
+                SquirrelDB().updateSquirrel(1, "Rocky", "small")
+            finally:
+                lock.execute("ROLLBACK")
+                lock.close()
+            stats = SquirrelDB.getWriteBehindStats()
+            assert stats["flushErrors"] == 1
+            assert stats["pending"] == 1
+            assert SquirrelDB().getSquirrel(1)["size"] == "small"
+            assert writeBehind.flush() == 1
+            assert _read_disk(db_file, 1) == ("Rocky", "small")
+
+        def counts_staleness_overruns_while_flushes_fail(db_file):
+            SquirrelDB().createSquirrel("Rocky", "large")
+            writeBehind = SquirrelDB.enableWriteBehind(flushInterval=0.01, maxStaleness=60)
+            writeBehind.busyTimeout = 0
+            writeBehind.maxStaleness = 0
+            lock = sqlite3.connect(db_file, isolation_level=None)
+            lock.execute("BEGIN IMMEDIATE")
+            try:
+                with writeBehind.lock:
+                    writeBehind.pending[1] = {"id": 1, "name": "Rocky", "size": "small"}
+                    writeBehind.oldestPendingAt = time.monotonic()
+                deadline = time.monotonic() + 2
+                while SquirrelDB.getWriteBehindStats()["stalenessOverruns"] == 0 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+            finally:
+                lock.execute("ROLLBACK")
+                lock.close()
+            stats = SquirrelDB.getWriteBehindStats()
+            assert stats["stalenessOverruns"] > 0
+            assert stats["flushErrors"] > 0
+            assert stats["oldestPendingAge"] > 0
+
+        def restores_rows_when_flush_is_interrupted(db_file, monkeypatch):
+            SquirrelDB().createSquirrel("Rocky", "large")
+            writeBehind = SquirrelDB.enableWriteBehind(flushInterval=60, maxStaleness=60)
+            SquirrelDB().updateSquirrel(1, "Rocky", "small")
+            def interrupted(*args, **kwargs):
+                raise SystemExit(0)
+            with monkeypatch.context() as patched:
+                patched.setattr(squirrel_db.sqlite3, "connect", interrupted)
+                with pytest.raises(SystemExit):
+                    writeBehind.flush()
+            assert SquirrelDB.getWriteBehindStats()["pending"] == 1
+            assert writeBehind.flush() == 1
+            assert _read_disk(db_file, 1) == ("Rocky", "small")
+
+        def ignores_non_canonical_id_on_update(db_file):
+            SquirrelDB().createSquirrel("Rocky", "large")
+            writeBehind = SquirrelDB.enableWriteBehind(flushInterval=60, maxStaleness=60)
+            SquirrelDB().updateSquirrel("1", "Old", "large")
+            for squirrelId in ["1.0", "+1", "01", "1_0", "\u0661"]:
+                SquirrelDB().updateSquirrel(squirrelId, "New", "small")
+                assert SquirrelDB().getSquirrel(squirrelId) is None
+            writeBehind.flush()
+            assert _read_disk(db_file, 1) == ("Old", "large")
+
+        def ignores_non_canonical_id_on_delete(db_file):
+            SquirrelDB().createSquirrel("Rocky", "large")
+            SquirrelDB.enableWriteBehind(flushInterval=60, maxStaleness=60)
+            SquirrelDB().updateSquirrel("1", "Rocky", "small")
+            SquirrelDB().deleteSquirrel("1.0")
+            assert SquirrelDB().getSquirrel("1")["size"] == "small"
+            assert _read_disk(db_file, 1) == ("Rocky", "large")
+
+        def uses_squirrel_passed_by_caller(db_file, monkeypatch):
+            SquirrelDB().createSquirrel("Rocky", "large")
+            SquirrelDB.enableWriteBehind(flushInterval=60, maxStaleness=60)
+            db = SquirrelDB()
+            squirrel = db.getSquirrel("1")
+            def unexpected(squirrelId):
+                raise AssertionError("squirrel looked up twice")
+            monkeypatch.setattr(db, "getSquirrel", unexpected)
+            db.updateSquirrel("1", "Rocky", "small", squirrel)
+            assert SquirrelDB().getSquirrel("1")["size"] == "small"
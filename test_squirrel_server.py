@@ -1,11 +1,16 @@
 import os
 import json
 import shutil
+import sqlite3
 import subprocess
+import threading
 import time
 import pytest
 import requests
+from http.server import HTTPServer
 from pytest import fixture
+from squirrel_db import SquirrelDB
+from squirrel_server import SquirrelServerHandler
 
 BASE_URL = "http://127.0.0.1:8082"
 DB_FILE = "squirrel_db.db"
@@ -164,20 +169,17 @@ def describe_SquirrelServer():
             squirrels = list_response.json()
             assert len(squirrels) == 2
         
-        # def it_returns_400_when_name_missing(server_process, clean_db):
-        
-        #     response = requests.post(f"{BASE_URL}/squirrels", data={"size": "large"})
-        #     assert response.status_code == 400
+        def it_returns_400_when_name_missing(server_process, clean_db):
+            response = requests.post(f"{BASE_URL}/squirrels", data={"size": "large"})
+            assert response.status_code == 400
 
-        # def it_returns_400_when_size_missing(server_process, clean_db):
-        
-        #     response = requests.post(f"{BASE_URL}/squirrels", data={"name": "Rocky"})
-        #     assert response.status_code == 400
+        def it_returns_400_when_size_missing(server_process, clean_db):
+            response = requests.post(f"{BASE_URL}/squirrels", data={"name": "Rocky"})
+            assert response.status_code == 400
 
-        # def it_returns_400_when_both_fields_missing(server_process, clean_db):
-        
-        #     response = requests.post(f"{BASE_URL}/squirrels", data={})
-        #     assert response.status_code == 400
+        def it_returns_400_when_both_fields_missing(server_process, clean_db):
+            response = requests.post(f"{BASE_URL}/squirrels", data={})
+            assert response.status_code == 400
     
     def describe_PUT_squirrels_id():   
         def it_returns_204_status(server_process, clean_db):
@@ -223,17 +225,15 @@ def describe_SquirrelServer():
             updated = get_response.json()
             assert updated["name"] == "Charmeleon" and updated["size"] == "medium"
 
-        # def it_returns_400_when_update_missing_name_or_size(server_process, clean_db):
-        #     requests.post(f"{BASE_URL}/squirrels", data={"name": "Testy", "size": "small"})
-        #     squirrel_id = requests.get(f"{BASE_URL}/squirrels").json()[0]["id"]
+        def it_returns_400_when_update_missing_name_or_size(server_process, clean_db):
+            requests.post(f"{BASE_URL}/squirrels", data={"name": "Testy", "size": "small"})
+            squirrel_id = requests.get(f"{BASE_URL}/squirrels").json()[0]["id"]
 
-            
-        #     res1 = requests.put(f"{BASE_URL}/squirrels/{squirrel_id}", data={"size": "big"})
-        #     assert res1.status_code == 400
+            res1 = requests.put(f"{BASE_URL}/squirrels/{squirrel_id}", data={"size": "big"})
+            assert res1.status_code == 400
 
-            
-        #     res2 = requests.put(f"{BASE_URL}/squirrels/{squirrel_id}", data={"name": "Testy2"})
-        #     assert res2.status_code == 400
+            res2 = requests.put(f"{BASE_URL}/squirrels/{squirrel_id}", data={"name": "Testy2"})
+            assert res2.status_code == 400
         
     
     def describe_DELETE_squirrels_id():
@@ -272,6 +272,107 @@ def describe_SquirrelServer():
             assert squirrels[0]["name"] == "Keep"
         
     
+    def describe_JSON_bodies():
+        def it_create_squirrel_from_json(server_process, clean_db):
+            response = requests.post(f"{BASE_URL}/squirrels", json={"name": "Rocky", "size": "large"})
+            assert response.status_code == 201
+            squirrel = requests.get(f"{BASE_URL}/squirrels").json()[0]
+            assert squirrel["name"] == "Rocky" and squirrel["size"] == "large"
+
+        def it_update_squirrel_from_json(server_process, clean_db):
+            requests.post(f"{BASE_URL}/squirrels", json={"name": "Rocky", "size": "large"})
+            squirrel_id = requests.get(f"{BASE_URL}/squirrels").json()[0]["id"]
+            response = requests.put(f"{BASE_URL}/squirrels/{squirrel_id}", json={"name": "Rocky", "size": "small"})
+            assert response.status_code == 204
+            assert requests.get(f"{BASE_URL}/squirrels/{squirrel_id}").json()["size"] == "small"
+
+        def it_create_squirrels_from_json_array(server_process, clean_db):
+            squirrels = [{"name": f"Bulk{i}", "size": "small"} for i in range(500)]
+            response = requests.post(f"{BASE_URL}/squirrels", json=squirrels)
+            assert response.status_code == 201
+            assert len(requests.get(f"{BASE_URL}/squirrels").json()) == 500
+
+        def it_create_nothing_when_array_item_invalid(server_process, clean_db):
+            squirrels = [{"name": "Good", "size": "small"}, {"name": "Bad"}]
+            response = requests.post(f"{BASE_URL}/squirrels", json=squirrels)
+            assert response.status_code == 400
+            assert len(requests.get(f"{BASE_URL}/squirrels").json()) == 0
+
+        def it_return_400_for_invalid_json(server_process, clean_db):
+            response = requests.post(f"{BASE_URL}/squirrels", data="{bad", headers={"Content-Type": "application/json"})
+            assert response.status_code == 400
+
+        def it_return_400_for_syntax_error_before_limit(server_process, clean_db):
+            body = '[{"name": bad}' + " " * 100000 + "]"
+            response = requests.post(f"{BASE_URL}/squirrels", data=body, headers={"Content-Type": "application/json"})
+            assert response.status_code == 400
+
+        def it_create_squirrels_split_across_reads(server_process, clean_db):
+            squirrels = [{"name": "x" * 1000 + str(i), "size": "-Infinity"} for i in range(100)]
+            response = requests.post(f"{BASE_URL}/squirrels", json=squirrels)
+            assert response.status_code == 201
+            assert len(requests.get(f"{BASE_URL}/squirrels").json()) == 100
+
+        def it_return_413_for_oversized_body(server_process, clean_db):
+            response = requests.post(f"{BASE_URL}/squirrels", json={"name": "a" * 100000, "size": "large"})
+            assert response.status_code == 413
+
+        def it_return_415_for_unsupported_content_type(server_process, clean_db):
+            response = requests.post(f"{BASE_URL}/squirrels", data="<squirrel/>", headers={"Content-Type": "text/xml"})
+            assert response.status_code == 415
+
+    def describe_write_behind():
+        @fixture
+        def write_behind_url(clean_db):
+            # In-process server, since the session server already owns port 8082.
+            SquirrelDB.enableWriteBehind(flushInterval=60, maxStaleness=60)
+            server = HTTPServer(("127.0.0.1", 0), SquirrelServerHandler)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            yield f"http://127.0.0.1:{server.server_port}"
+            server.shutdown()
+            server.server_close()
+            SquirrelDB.disableWriteBehind()
+
+        def _read_disk(squirrel_id):
+            connection = sqlite3.connect(DB_FILE)
+            row = connection.execute("SELECT name, size FROM squirrels WHERE id = ?", [squirrel_id]).fetchone()
+            connection.close()
+            return row
+
+        def it_serve_latest_update_before_flush(write_behind_url):
+            requests.post(f"{write_behind_url}/squirrels", data={"name": "Rocky", "size": "large"})
+            squirrel_id = requests.get(f"{write_behind_url}/squirrels").json()[0]["id"]
+            for size in ["tiny", "small", "medium"]:
+                response = requests.put(f"{write_behind_url}/squirrels/{squirrel_id}", data={"name": "Rocky", "size": size})
+                assert response.status_code == 204
+            assert requests.get(f"{write_behind_url}/squirrels/{squirrel_id}").json()["size"] == "medium"
+            assert _read_disk(squirrel_id) == ("Rocky", "large")
+
+        def it_flush_coalesced_update_on_shutdown(write_behind_url):
+            requests.post(f"{write_behind_url}/squirrels", data={"name": "Rocky", "size": "large"})
+            squirrel_id = requests.get(f"{write_behind_url}/squirrels").json()[0]["id"]
+            requests.put(f"{write_behind_url}/squirrels/{squirrel_id}", data={"name": "Rocky", "size": "tiny"})
+            requests.put(f"{write_behind_url}/squirrels/{squirrel_id}", data={"name": "Rocky", "size": "small"})
+            SquirrelDB.disableWriteBehind()
+            assert _read_disk(squirrel_id) == ("Rocky", "small")
+
+        def it_return_404_for_non_canonical_id(write_behind_url):
+            requests.post(f"{write_behind_url}/squirrels", data={"name": "Rocky", "size": "large"})
+            squirrel_id = requests.get(f"{write_behind_url}/squirrels").json()[0]["id"]
+            requests.put(f"{write_behind_url}/squirrels/{squirrel_id}", data={"name": "Old", "size": "large"})
+            put_response = requests.put(f"{write_behind_url}/squirrels/{squirrel_id}.0", data={"name": "New", "size": "small"})
+            delete_response = requests.delete(f"{write_behind_url}/squirrels/{squirrel_id}.0")
+            assert put_response.status_code == 404
+            assert delete_response.status_code == 404
+            SquirrelDB.disableWriteBehind()
+            assert _read_disk(squirrel_id) == ("Old", "large")
+
+        def it_return_404_for_unknown_squirrel(write_behind_url):
+            response = requests.put(f"{write_behind_url}/squirrels/9000", data={"name": "Ghost", "size": "small"})
+            assert response.status_code == 404
+            assert SquirrelDB.getWriteBehindStats()["queued"] == 0
+
     def describe_404_errors():    
         def it_return_404_for_nonexistent_squirrel_get(server_process, clean_db):
             response = requests.get(f"{BASE_URL}/squirrels/9000")